@@ -4,60 +4,285 @@ See https://live-durhamnc.opendata.arcgis.com/datasets/DurhamNC::all-building-pe
 data source details.
 """
 
+import hashlib
 import math
+import os
+import tempfile
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, UTC
+from itertools import chain, islice
+from pathlib import Path
 
+import ijson
+import numpy as np
 import pandas as pd
+import pyarrow
 import pydeck as pdk
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+FIELDS = (
+    "ISSUE_DATE",
+    "DESCRIPTION",
+    "COMMENTS",
+    "TYPE",
+    "BLDB_ACTIVITY_1",
+    "BLD_Type",
+    "Occupancy",
+    "PmtStatus",
+)
+# On-disk copies of query results outlive process restarts, unlike st.cache_data
+CACHE_DIR = Path(".cache")
+CACHE_TTL = 3600
+URL = "https://webgis2.durhamnc.gov/server/rest/services/PublicServices/Inspections/MapServer/12/query"
+
+# Shared across queries and page fetch threads to reuse keep-alive connections. When the brotli
+# package is installed, requests adds br to its default Accept-Encoding and urllib3 decodes it.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504]
+        ),
+    ),
+)
+
+
+def where_clause(
+    date_range: tuple[datetime, datetime],
+    bld_type: tuple[str, ...] = (),
+    activity: tuple[str, ...] = (),
+) -> str:
+    """Builds an ArcGIS SQL WHERE clause matching permits by issue date, type, and activity."""
+    clauses = [
+        # https://developers.arcgis.com/rest/services-reference/enterprise/query-feature-service-layer/#date-time-queries
+        f"ISSUE_DATE >= TIMESTAMP '{date_range[0]:%Y-%m-%d} 00:00:00' AND ISSUE_DATE <= TIMESTAMP '{date_range[1]:%Y-%m-%d} 23:59:59'"
+    ]
+    for field, values in (("TYPE", bld_type), ("BLDB_ACTIVITY_1", activity)):
+        if values:
+            quoted = ",".join("'{}'".format(v.replace("'", "''")) for v in values)
+            clauses.append(f"{field} IN ({quoted})")
+    return " AND ".join(clauses)
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def distinct(date_range: tuple[datetime, datetime], field: str) -> list[str]:
+    """Fetches the sorted, distinct values of a permit field within a date range."""
+    params = {
+        "where": where_clause(date_range),
+        "outFields": field,
+        "orderByFields": field,
+        "returnDistinctValues": "true",
+        "returnGeometry": "false",
+        "f": "json",
+    }
+    resp = SESSION.get(URL, params=params)
+    resp.raise_for_status()
+    values = (row["attributes"][field] for row in resp.json()["features"])
+    return [value for value in values if value is not None]
+
+
+def check_error(events: Iterator[tuple]) -> Iterator[tuple]:
+    """Raises if an ijson event stream is an ArcGIS error body, which comes back with HTTP 200.
+
+    Otherwise returns the events unconsumed."""
+    head = list(islice(events, 2))
+    events = chain(head, events)
+    if head[1:] == [("", "map_key", "error")]:
+        error = next(ijson.items(events, "error"))
+        raise RuntimeError(f"ArcGIS query failed: {error.get('message', error)}")
+    return events
+
+
+def with_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Casts permit columns to the dtypes the app works with.
+
+    Applied to both fetched and cached frames so they come out identical."""
+    return (
+        # Arrow-backed strings use vectorized kernels for str.contains and friends
+        df.astype({k: "string[pyarrow]" for k in FIELDS if k != "ISSUE_DATE"})
+        # float32 keeps WGS84 degrees to well under a meter around Durham at half the size
+        .astype({"lon": "float32", "lat": "float32"})
+    )
 
 
-@st.cache_data(ttl=3600)
+def save_cache(df: pd.DataFrame, path: Path):
+    """Writes a query result to the on-disk cache, pruning expired entries first."""
+    # Drop expired cache files, since every date range and filter set writes its own, along with
+    # temp files left behind by killed writers
+    CACHE_DIR.mkdir(exist_ok=True)
+    for expired in CACHE_DIR.glob("permits_*"):
+        try:
+            if time.time() - expired.stat().st_mtime >= CACHE_TTL:
+                expired.unlink()
+        except FileNotFoundError:
+            # Another session already removed it
+            pass
+
+    # Write to a temp file and rename so readers never see a partially written cache file
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix="permits_", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            df.to_parquet(f, compression="zstd")
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@st.cache_data(ttl=CACHE_TTL)
 def query(
     date_range: tuple[datetime, datetime],
+    bld_type: tuple[str, ...] = (),
+    activity: tuple[str, ...] = (),
     max_per_page: int = 2000,
     max_pages: int = 100,
+    max_workers: int = 8,
 ) -> pd.DataFrame:
-    """Fetches GeoJSON pages of permit data from Durham's ArcGIS server."""
-    all_rows = []
-    for i in range(max_pages):
+    """Fetches GeoJSON pages of permit data from Durham's ArcGIS server.
+
+    Filters by type and activity on the server when given. Counts the matching permits first, then
+    fetches all pages concurrently. Reuses a recent result from the on-disk cache if one exists.
+    """
+    key = hashlib.sha1(repr((bld_type, activity)).encode()).hexdigest()[:12]
+    path = (
+        CACHE_DIR
+        / f"permits_{date_range[0]:%Y%m%d}_{date_range[1]:%Y%m%d}_{key}.parquet"
+    )
+    if path.exists() and time.time() - path.stat().st_mtime < CACHE_TTL:
+        try:
+            return with_dtypes(pd.read_parquet(path))
+        except (OSError, pyarrow.ArrowException):
+            # Fall through to refetch and overwrite an unreadable cache file
+            pass
+
+    base_params = {
+        "where": where_clause(date_range, bld_type, activity),
+        "f": "json",
+    }
+    resp = SESSION.get(URL, params={**base_params, "returnCountOnly": "true"})
+    resp.raise_for_status()
+    total = resp.json()["count"]
+    if total > max_pages * max_per_page:
+        raise RuntimeError("max_pages exceeded")
+
+    def fetch_page(offset: int) -> dict[str, list]:
         params = {
-            "outFields": "ISSUE_DATE,DESCRIPTION,COMMENTS,TYPE,BLDB_ACTIVITY_1,BLD_Type,Occupancy,PmtStatus",
+            **base_params,
+            "outFields": ",".join(FIELDS),
             "outSR": 4326,
-            "resultOffset": i * max_per_page,
+            # Six decimal places of WGS84 degrees is ~0.1 m, plenty for plotting permits
+            "geometryPrecision": 6,
+            # A stable order keeps concurrently fetched offset pages from overlapping
+            "orderByFields": "OBJECTID",
+            "resultOffset": offset,
             "resultRecordCount": max_per_page,
-            # https://developers.arcgis.com/rest/services-reference/enterprise/query-feature-service-layer/#date-time-queries
-            "where": f"ISSUE_DATE >= TIMESTAMP '{date_range[0]:%Y-%m-%d} 00:00:00' AND ISSUE_DATE <= TIMESTAMP '{date_range[1]:%Y-%m-%d} 23:59:59'",
-            "f": "json",
         }
-        resp = requests.get(
-            "https://webgis2.durhamnc.gov/server/rest/services/PublicServices/Inspections/MapServer/12/query",
-            params=params,
-        )
-        resp.raise_for_status()
-
-        rows = [
-            {**row["attributes"], **row.get("geometry", {})}
-            for row in resp.json()["features"]
-        ]
-        all_rows.extend(rows)
+        # Accumulate columns directly rather than building a dict per feature, and stream
+        # features out of the response rather than parsing the whole page up front
+        cols = {k: [] for k in (*FIELDS, "lon", "lat")}
+        # Bind the list appends once rather than looking them up for every feature
+        appends = [(k, cols[k].append) for k in FIELDS]
+        append_lon, append_lat = cols["lon"].append, cols["lat"].append
+        with SESSION.get(URL, params=params, stream=True) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            events = check_error(ijson.parse(resp.raw, use_float=True))
+            for row in ijson.items(events, "features.item"):
+                attrs = row["attributes"]
+                geometry = row.get("geometry") or {}
+                for k, append in appends:
+                    append(attrs.get(k))
+                append_lon(geometry.get("x"))
+                append_lat(geometry.get("y"))
+        return cols
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = list(executor.map(fetch_page, range(0, total, max_per_page)))
+    # Short pages (a server maxRecordCount below max_per_page) or permits added since the count
+    # would otherwise drop or duplicate rows silently
+    fetched = sum(len(page["ISSUE_DATE"]) for page in pages)
+    if fetched != total:
+        raise RuntimeError(f"fetched {fetched} permits, expected {total}")
+
+    df = pd.DataFrame(
+        {
+            k: list(chain.from_iterable(page[k] for page in pages))
+            for k in (*FIELDS, "lon", "lat")
+        }
+    )
+    df = with_dtypes(
+        df.assign(ISSUE_DATE=pd.to_datetime(df.ISSUE_DATE, unit="ms", cache=True))
+    )
+    # Sort newest first on the raw int64 timestamps, which also puts NaT last
+    order = np.argsort(df.ISSUE_DATE.to_numpy().view("int64"), kind="stable")[::-1]
+    df = df.take(order)
+    try:
+        save_cache(df, path)
+    except OSError:
+        # The disk cache is only an optimization, so a read-only or full disk shouldn't fail the page
+        pass
+    return df
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def filter_df(
+    date_range: tuple[datetime, datetime],
+    bld_type: tuple[str, ...],
+    activity: tuple[str, ...],
+    text: str,
+) -> pd.DataFrame:
+    """Filters permits in a date range by type, activity, and description or comment text.
+
+    Type and activity filters run on the server. The text filter runs locally, if given.
+    """
+    df = query(date_range, bld_type, activity)
+    if not text:
+        return df
+    # OR the two column matches into one NumPy mask instead of aligning pandas Series
+    in_description = df.DESCRIPTION.str.contains(
+        text, case=False, regex=False, na=False
+    )
+    in_comments = df.COMMENTS.str.contains(text, case=False, regex=False, na=False)
+    mask = in_description.to_numpy(dtype=bool, copy=True)
+    np.logical_or(mask, in_comments.to_numpy(dtype=bool), out=mask)
+    return df.iloc[mask]
 
-        if len(rows) < max_per_page:
-            break
-    else:
-        raise RuntimeError("max_pages exceeded")
 
-    df = pd.DataFrame(all_rows)
-    return (
-        (
-            df.assign(ISSUE_DATE=pd.to_datetime(df.ISSUE_DATE, unit="ms"))
-            .rename(columns={"x": "lon", "y": "lat"})
-            .sort_values("ISSUE_DATE", ascending=False)
-        )
-        if len(df)
-        else df
-    )
+@st.cache_data(ttl=CACHE_TTL)
+def map_points(
+    date_range: tuple[datetime, datetime],
+    bld_type: tuple[str, ...],
+    activity: tuple[str, ...],
+    text: str,
+) -> list[dict]:
+    """Encodes the locations of filtered permits as map layer records.
+
+    Only the coordinates go to the browser, rounded back to the six decimals the server returns.
+    """
+    df = filter_df(date_range, bld_type, activity, text)
+    return df[["lon", "lat"]].astype("float64").round(6).to_dict("records")
+
+
+def map_view(df: pd.DataFrame) -> tuple[float, float, float]:
+    """Computes the center latitude, center longitude, and bounds-based zoom for permit locations."""
+    coords = df[["lon", "lat"]].dropna().to_numpy()
+    if not len(coords):
+        return math.nan, math.nan, 15
+
+    # Reduce over the (N, 2) array once per statistic instead of per column
+    (lon_min, lat_min), (lon_max, lat_max) = coords.min(axis=0), coords.max(axis=0)
+    center_lon, center_lat = coords.mean(axis=0)
+    angle = max(lon_max - lon_min, lat_max - lat_min)
+    zoom = min(max(math.log2(360 / angle), 8), 15) if angle else 15
+    return float(center_lat), float(center_lon), zoom
 
 
 def reset_table():
@@ -73,7 +298,9 @@ def on_table_select():
     key = f"table_{st.session_state.get('table_idx', 0)}"
     table = st.session_state[key]
     if table.selection.rows:
-        st.session_state.selected_df = df.iloc[table.selection.rows]
+        st.session_state.selected_df = df.take(
+            np.asarray(table.selection.rows, dtype=np.intp)
+        )
     elif "selected_df" in st.session_state:
         del st.session_state.selected_df
 
@@ -83,10 +310,9 @@ def on_map_select():
     is selected."""
     reset_table()
     df = st.session_state.df
-    if "scatterplot" in st.session_state.map.selection.indices:
-        st.session_state.selected_df = df.iloc[
-            st.session_state.map.selection.indices["scatterplot"]
-        ]
+    indices = st.session_state.map.selection.indices.get("scatterplot")
+    if indices:
+        st.session_state.selected_df = df.take(np.asarray(indices, dtype=np.intp))
     elif "selected_df" in st.session_state:
         del st.session_state.selected_df
 
@@ -120,26 +346,19 @@ def main():
     if len(date_range) < 2:
         date_range = (date_range[0], utcnow.date())
 
-    df = query(date_range)
-
-    # Show the number of matching permits
-    st.caption(f"{len(df)} matching permits")
-    if not len(df):
-        return
-
     # Show additional filters for permit type, activity, and comment/description text
     with b:
         bld_type = st.multiselect(
             "Type",
             placeholder="Filter by building type",
-            options=df.TYPE.drop_duplicates().sort_values(),
+            options=distinct(date_range, "TYPE"),
             on_change=on_filter_change,
         )
     with c:
         activity = st.multiselect(
             "Activity",
             placeholder="Filter by activity",
-            options=df.BLDB_ACTIVITY_1.drop_duplicates().sort_values(),
+            options=distinct(date_range, "BLDB_ACTIVITY_1"),
             on_change=on_filter_change,
         )
     with d:
@@ -149,15 +368,15 @@ def main():
             on_change=on_filter_change,
         )
 
-    # Perform all other filtering locally
-    st.session_state.df = df = df[
-        (df.TYPE.isin(bld_type) if bld_type else True)
-        & (df.BLDB_ACTIVITY_1.isin(activity) if activity else True)
-        & (
-            df.DESCRIPTION.str.contains(text, case=False)
-            | df.COMMENTS.str.contains(text, case=False)
-        )
-    ]
+    # Fetch and filter the matching permits, caching the result so reruns for map and table
+    # selections skip it. Sort the selections so the cache keys ignore click order.
+    filters = (date_range, tuple(sorted(bld_type)), tuple(sorted(activity)), text)
+    st.session_state.df = df = filter_df(*filters)
+
+    # Show the number of matching permits
+    st.caption(f"{len(df)} matching permits")
+    if not len(df):
+        return
 
     a, b = st.columns(2)
     with a:
@@ -176,23 +395,20 @@ def main():
     map_focus_df = (
         st.session_state.selected_df if "selected_df" in st.session_state else df
     )
-    longitude_range = map_focus_df.lon.max() - map_focus_df.lon.min()
-    latitude_range = map_focus_df.lat.max() - map_focus_df.lat.min()
-    angle = max(longitude_range, latitude_range)
-    zoom = min(max(math.log2(360 / angle), 8), 15) if angle else 15
+    center_lat, center_lon, zoom = map_view(map_focus_df)
 
     # Render a map of all the locations with lat, lon
     deck = pdk.Deck(
         map_style=None,
         initial_view_state=pdk.ViewState(
-            latitude=map_focus_df.lat.mean(),
-            longitude=map_focus_df.lon.mean(),
+            latitude=center_lat,
+            longitude=center_lon,
             zoom=zoom,
         ),
         layers=[
             pdk.Layer(
                 "ScatterplotLayer",
-                data=df,
+                data=map_points(*filters),
                 id="scatterplot",
                 get_position="[lon, lat]",
                 get_color="[255, 90, 255, 160]",